@@ -1,12 +1,40 @@
 import firefly_iii_client as ff
+import threading
+import urllib3
+from types import SimpleNamespace
+
+from governor import RequestGovernor
+from nameindex import NameIndex
+from transport import LeanTransport
+
+# outcomes of sendTx
+INSERTED = "inserted"
+DUPLICATE = "duplicate"
+DROPPED = "dropped"
+SKIPPED = "skipped"
 
 class Firefly:
-    def __init__(self, host, token):
+    def __init__(self, host, token, maxInFlight=1, lean=False):
         self.conf = ff.configuration.Configuration(
             host = host,
         )
         self.conf.access_token = token
+        # the governor is the only retry layer: urllib3 would otherwise retry 429/503 on its own,
+        # sleeping out Retry-After while holding an in-flight slot the governor knows nothing about
+        self.conf.retries = urllib3.Retry(0, respect_retry_after_header=False)
+        self.conf.connection_pool_maxsize = max(maxInFlight, self.conf.connection_pool_maxsize)
         self.client = ff.ApiClient(self.conf)
+        self.governor = RequestGovernor(maxInFlight)
+        # hot endpoints (searches, transaction store) can skip the generated models
+        self.lean = LeanTransport(self.conf, maxInFlight) if lean else None
+
+        # account lookups by (identifier, account type, search field), misses are cached as None
+        self.accountCache = {}
+        self.cacheHits = 0
+        self.cacheMisses = 0
+        self._cacheLock = threading.Lock()
+        self._createLock = threading.Lock()
+        self.nameIndexes = {}
     
     def createTag(self, tag, date):
         fftag = ff.TagModelStore(
@@ -14,33 +42,66 @@ class Firefly:
             date=date,
         )
 
-        ff.TagsApi(self.client).store_tag(fftag)
+        try:
+            # a retried store that had already gone through finds our own tag
+            self.governor.call(ff.TagsApi(self.client).store_tag, fftag)
+        except ff.exceptions.ApiException as e:
+            if "This tag is already in use." in e.body:
+                print("Tag {} already exists.".format(tag))
+            else:
+                raise e
     
-    def sendTx(self, txSplit, debug=False):
-        if txSplit.external_id:
-            existing = self.getTransactionByExternalId(txSplit.external_id)
-            if existing:
-                print("Transaction {} already exists - skipping.".format(txSplit.description))
-                return
+    def sendTx(self, txSplit, debug=False, checkExisting=True):
+        return self.sendGroup([txSplit], None, debug, checkExisting)[0]
+
+    def sendGroup(self, txSplits, title=None, debug=False, checkExisting=True):
+        """Stores the splits as one transaction group, returns the outcome for each split."""
+        outcomes = [None] * len(txSplits)
+        if checkExisting:
+            for i, txSplit in enumerate(txSplits):
+                if txSplit.external_id and self.getTransactionByExternalId(txSplit.external_id):
+                    print("Transaction {} already exists - skipping.".format(txSplit.description))
+                    outcomes[i] = DUPLICATE
+        pending = [i for i, outcome in enumerate(outcomes) if outcome is None]
+        if not pending:
+            return outcomes
+
+        def done(outcome):
+            for i in pending:
+                outcomes[i] = outcome
+            return outcomes
+
+        splits = [txSplits[i] for i in pending]
         tx = ff.TransactionStore(
             apply_rules=True,
             fire_webhooks=True,
             error_if_duplicate_hash=True,
-            transactions=[txSplit],
+            group_title=title if len(splits) > 1 else None,
+            transactions=splits,
         )
         if debug:
             print("Debug active - not storing transaction:")
             import pprint
-            pprint.pprint(txSplit)
-            return
+            pprint.pprint(tx if len(splits) > 1 else splits[0])
+            return done(SKIPPED)
         try:
-            print("Storing transaction {}.".format(txSplit.description))
-            ff.TransactionsApi(self.client).store_transaction(tx)
+            if len(splits) > 1:
+                print("Storing transaction group {} with {} splits.".format(title, len(splits)))
+            else:
+                print("Storing transaction {}.".format(splits[0].description))
+            # safe to retry: a store that did go through is rejected by the duplicate hash check
+            if self.lean:
+                self.governor.call(self.lean.store_transaction, tx)
+            else:
+                self.governor.call(ff.TransactionsApi(self.client).store_transaction, tx)
+            return done(INSERTED)
         except ff.exceptions.ApiException as e:
             if "Duplicate of transaction" in e.body:
                 print("Transaction is a duplicate: {}".format(e.body[-10:]))
+                return done(DUPLICATE)
             elif "Possibly, a rule deleted this transaction after its creation." in e.body:
                 print("Transaction was dropped by a rule.")
+                return done(DROPPED)
             else:
                 raise e
     
@@ -50,7 +111,20 @@ class Firefly:
     def createExpenseAccount(self, iban, name):
         return self.createAccount(iban, name, ff.ShortAccountTypeProperty.EXPENSE)
     
-    def createAccount(self, iban, name, atype, add_iban=False):
+    def createAccount(self, iban, name, atype):
+        # concurrent imports against this host may race to create the same counterparty
+        with self._createLock:
+            key = (iban, atype.value, ff.AccountSearchFieldFilter.IBAN.value)
+            with self._cacheLock:
+                account = self.accountCache.get(key)
+            if account:
+                return account
+            account = self._storeAccount(iban, name, atype)
+            with self._cacheLock:
+                self.accountCache[key] = account
+            return account
+
+    def _storeAccount(self, iban, name, atype, add_iban=False):
         rname = name
         if add_iban:
             rname = "{} ({})".format(name, iban)
@@ -60,24 +134,78 @@ class Firefly:
             name=rname,
             type=atype,
         )
+
+        def findStored():
+            # after a 5xx the store may have gone through, so look before storing again
+            existing = self._searchAccount(iban, ff.AccountTypeFilter(atype.value), ff.AccountSearchFieldFilter.IBAN)
+            return SimpleNamespace(data=existing) if existing else None
+
         try:
-            return ff.AccountsApi(self.client).store_account(acct).data
+            return self.governor.call(ff.AccountsApi(self.client).store_account, acct, idempotent=False,
+                                      recover=findStored).data
         except ff.exceptions.ApiException as e:
             if "This account name is already in use." in e.body:
                 if not add_iban:
                     print("Account name is in use, retrying...")
-                    return self.createAccount(iban, name, atype, True)
+                    return self._storeAccount(iban, name, atype, True)
             raise e
 
     
     def getTransactionByExternalId(self, external_id):
-        resp = ff.SearchApi(self.client).search_transactions(
+        if self.lean:
+            return self.governor.call(
+                self.lean.search_transactions,
+                query="external_id:{}".format(external_id),
+            )
+        resp = self.governor.call(
+            ff.SearchApi(self.client).search_transactions,
             query="external_id:{}".format(external_id),
         )
         if len(resp.data) > 0:
             return resp.data[0]
         return None
 
+    def getLatestTransactionDate(self, accountId):
+        resp = self.governor.call(
+            ff.AccountsApi(self.client).list_transaction_by_account,
+            accountId,
+            limit=1,
+        )
+        if len(resp.data) > 0:
+            return resp.data[0].attributes.transactions[0].var_date
+        return None
+
+    def listAccounts(self, accType):
+        accounts = []
+        page = 1
+        while True:
+            resp = self.governor.call(
+                ff.AccountsApi(self.client).list_account,
+                type=accType,
+                page=page,
+                limit=500,
+            )
+            accounts.extend(resp.data)
+            if page >= resp.meta.pagination.total_pages:
+                return accounts
+            page += 1
+
+    def getNameIndex(self, accType, threshold):
+        # built once per run (and shared by all imports using this client)
+        with self._createLock:
+            if accType.value not in self.nameIndexes:
+                index = NameIndex(threshold)
+                for account in self.listAccounts(accType):
+                    index.add(account.attributes.name, account.id)
+                self.nameIndexes[accType.value] = index
+            return self.nameIndexes[accType.value]
+
+    def getExpenseNameIndex(self, threshold):
+        return self.getNameIndex(ff.AccountTypeFilter.EXPENSE, threshold)
+
+    def getRevenueNameIndex(self, threshold):
+        return self.getNameIndex(ff.AccountTypeFilter.REVENUE, threshold)
+
     def getRevenueAccountByIban(self, iban):
         return self.getAccountByIban(iban, ff.AccountTypeFilter.REVENUE)
 
@@ -94,7 +222,27 @@ class Firefly:
         return self.getAccount(iban, accType, ff.AccountSearchFieldFilter.IBAN)
     
     def getAccount(self, identifier, accType, searchField):
-        resp = ff.SearchApi(self.client).search_accounts(
+        key = (identifier, accType.value, searchField.value)
+        with self._cacheLock:
+            if key in self.accountCache:
+                self.cacheHits += 1
+                return self.accountCache[key]
+            self.cacheMisses += 1
+        account = self._searchAccount(identifier, accType, searchField)
+        with self._cacheLock:
+            # keep an account created by a concurrent import while we were searching
+            return self.accountCache.setdefault(key, account)
+
+    def _searchAccount(self, identifier, accType, searchField):
+        if self.lean:
+            return self.governor.call(
+                self.lean.search_accounts,
+                query=identifier,
+                field=searchField,
+                type=accType,
+            )
+        resp = self.governor.call(
+            ff.SearchApi(self.client).search_accounts,
             query=identifier,
             field=searchField,
             type=accType,
@@ -0,0 +1,194 @@
+import email.utils
+import random
+import threading
+import time
+from collections import deque
+
+import firefly_iii_client as ff
+
+# Statuses our reverse proxy / Firefly return when they are (temporarily) overloaded.
+RETRY_STATUSES = (429, 502, 503, 504)
+
+
+class RequestGovernor:
+    """
+    Gates every Firefly API call.
+
+    Transient failures are retried with jittered exponential backoff (honouring Retry-After),
+    and the number of requests allowed in flight is adapted AIMD style: it grows by one per
+    round trip, and is halved on overload responses or when latency rises with the number of
+    requests in flight. Latency that is merely noisy, or slow at any concurrency, leaves it alone.
+    """
+
+    def __init__(self, maxInFlight=8, minInFlight=1, maxRetries=6, baseDelay=0.5, maxDelay=60.0, latencyFactor=2.0,
+                 window=100):
+        self.maxInFlight = max(maxInFlight, minInFlight)
+        self.minInFlight = minInFlight
+        self.maxRetries = maxRetries
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.latencyFactor = latencyFactor
+
+        self.limit = float(min(2, self.maxInFlight))
+        self.inFlight = 0
+        # latency is tracked per endpoint, a search and a store have very different costs
+        self.avgLatency = {}
+        # recent (requests in flight, latency) per endpoint
+        self.window = window
+        self.samples = {}
+        self._lastDecrease = 0.0
+        self._limitSum = 0.0
+        self._cond = threading.Condition()
+
+        self.requests = 0
+        self.retries = 0
+        self.overloads = 0
+        self.latencies = []
+
+    def call(self, fn, *args, idempotent=True, recover=None, **kwargs):
+        """
+        Calls fn(*args, **kwargs) under the governor.
+
+        Non-idempotent calls are only retried on 429, where the server guarantees it
+        did not process the request. If recover is given, they are retried on 5xx as well,
+        but only after recover() (looking for what the failed call may have stored) returns None;
+        otherwise its result is returned.
+        """
+        attempt = 0
+        while True:
+            inFlight = self._acquire()
+            key = getattr(fn, '__name__', None)
+            start = time.monotonic()
+            try:
+                result = fn(*args, **kwargs)
+            except ff.exceptions.ApiException as e:
+                latency = time.monotonic() - start
+                self._release()
+                if e.status not in RETRY_STATUSES:
+                    # a regular error response (validation, duplicate...) - the server is fine
+                    self._onResponse(key, latency, inFlight)
+                    raise e
+                self._onOverload(key, latency)
+                if attempt >= self.maxRetries or not (idempotent or e.status == 429 or recover):
+                    raise e
+                delay = self.retryDelay(e, attempt)
+                print("Server responded with {}, retrying in {:.1f}s...".format(e.status, delay))
+                with self._cond:
+                    self.retries += 1
+                time.sleep(delay)
+                attempt += 1
+                if recover and not idempotent and e.status != 429:
+                    found = recover()
+                    if found is not None:
+                        return found
+                continue
+            except BaseException:
+                self._release()
+                raise
+            latency = time.monotonic() - start
+            self._release()
+            self._onResponse(key, latency, inFlight)
+            return result
+
+    def _acquire(self):
+        with self._cond:
+            while self.inFlight >= int(self.limit):
+                self._cond.wait()
+            self.inFlight += 1
+            self.requests += 1
+            return self.inFlight
+
+    def _release(self):
+        with self._cond:
+            self.inFlight -= 1
+            self._cond.notify_all()
+
+    def _onResponse(self, key, latency, inFlight):
+        with self._cond:
+            self.latencies.append(latency)
+            self._limitSum += self.limit
+            if key not in self.avgLatency:
+                self.avgLatency[key] = latency
+            else:
+                self.avgLatency[key] = 0.9 * self.avgLatency[key] + 0.1 * latency
+            samples = self.samples.setdefault(key, deque(maxlen=self.window))
+            samples.append((inFlight, latency))
+
+            if self._latencyGrowth(samples) > self.latencyFactor:
+                self._decrease(self.avgLatency[key])
+                samples.clear()
+            elif inFlight >= self.limit / 2:
+                # additive increase: +1 in-flight request per full window of successful round trips,
+                # as long as the window is actually used
+                self.limit = min(self.maxInFlight, self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+    def _latencyGrowth(self, samples):
+        """
+        How much slower a request at the current limit is than one on its own, from a least
+        squares fit of an endpoint's latency over requests in flight. 1.0 while the server keeps up.
+        """
+        if len(samples) < self.window // 4:
+            return 1.0
+        n = len(samples)
+        meanX = sum(x for x, _ in samples) / n
+        meanY = sum(y for _, y in samples) / n
+        varX = sum((x - meanX) ** 2 for x, _ in samples)
+        if varX < n * 0.25:
+            # (almost) always the same number in flight, nothing to compare against
+            return 1.0
+        slope = sum((x - meanX) * (y - meanY) for x, y in samples) / varX
+        intercept = meanY - slope * meanX
+        alone = max(intercept + slope * self.minInFlight, 0.1 * meanY)
+        return (intercept + slope * self.limit) / alone
+
+    def _onOverload(self, key, latency):
+        with self._cond:
+            self.overloads += 1
+            self._decrease(self.avgLatency.get(key, latency))
+
+    def _decrease(self, roundTrip):
+        # only back off once per round trip, otherwise a burst of concurrent failures
+        # would collapse the window straight to the minimum
+        now = time.monotonic()
+        if now - self._lastDecrease < roundTrip:
+            return
+        self._lastDecrease = now
+        self.limit = max(self.minInFlight, self.limit / 2)
+
+    def retryDelay(self, e, attempt):
+        backoff = random.uniform(0, min(self.maxDelay, self.baseDelay * 2 ** attempt))
+        retryAfter = self._parseRetryAfter(e.headers.get('Retry-After') if e.headers else None)
+        if retryAfter is not None:
+            return min(self.maxDelay, retryAfter) + random.uniform(0, self.baseDelay)
+        return backoff
+
+    @staticmethod
+    def _parseRetryAfter(value):
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            when = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, when.timestamp() - time.time())
+
+    def meanLatency(self):
+        if not self.latencies:
+            return None
+        return sum(self.latencies) / len(self.latencies)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'requests': self.requests,
+                'retries': self.retries,
+                'overloads': self.overloads,
+                'limit': int(self.limit),
+                'meanLimit': self._limitSum / len(self.latencies) if self.latencies else self.limit,
+                'latency': self.meanLatency(),
+            }
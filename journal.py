@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+import threading
+
+
+class ImportJournal:
+    """
+    Append-only record of one input file's import: the import tag, whether the tag was
+    created, a fingerprint of the input, and the external ID and outcome of every submitted
+    row. Outcomes are buffered and written (and fsynced) in batches; a crash loses at most
+    one batch, and those rows are caught by the duplicate hash on resume since the tag is reused.
+    """
+
+    def __init__(self, path, flushEvery=50):
+        self.path = path
+        self.flushEvery = flushEvery
+        self.tag = None
+        self.tagCreated = False
+        self.fingerprint = None
+        # row -> (external id, outcome) as confirmed by the runs being resumed; rows recorded
+        # by this run only go to the file, so statements imported side by side don't see each other's
+        self.resumed = {}
+        self.pending = []
+        self.lock = threading.Lock()
+        self.file = None
+
+    @staticmethod
+    def forInput(directory, host, path, member):
+        # the same file may be imported into several Firefly instances, each needs its own journal
+        key = "{}::{}::{}".format(host, os.path.abspath(path), member)
+        name = "{}-{}.journal".format(os.path.basename(member), hashlib.sha1(key.encode()).hexdigest()[:10])
+        return ImportJournal(os.path.join(directory, name))
+
+    def open(self, resume=False):
+        if resume and os.path.exists(self.path):
+            self._load()
+            mode = 'a'
+        else:
+            mode = 'w'
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.file = open(self.path, mode)
+        return self
+
+    def _load(self):
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # torn last line from a crash
+                    continue
+                if 'tag' in entry:
+                    self.tag = entry['tag']
+                    self.tagCreated = entry.get('created', False)
+                    self.fingerprint = entry.get('input')
+                if 'row' in entry:
+                    self.resumed[entry['row']] = (entry.get('id'), entry['outcome'])
+
+    def checkInput(self, fingerprint):
+        """Refuses to resume from a journal that was written for different contents of the same path."""
+        if self.tag and self.fingerprint != fingerprint:
+            raise ValueError("Journal {} was written for a different version of this input, refusing to resume. "
+                             "Delete it to import the file from scratch.".format(self.path))
+        self.fingerprint = fingerprint
+
+    def isConfirmed(self, row, externalId):
+        confirmed = self.resumed.get(row)
+        return confirmed is not None and confirmed[0] == externalId
+
+    def recordTag(self, tag, created=False):
+        with self.lock:
+            self.tag = tag
+            self.tagCreated = created
+            self.pending.append({'tag': tag, 'created': created, 'input': self.fingerprint})
+            self._flush()
+
+    def record(self, row, externalId, outcome):
+        with self.lock:
+            self.pending.append({'row': row, 'id': externalId, 'outcome': outcome})
+            if len(self.pending) >= self.flushEvery:
+                self._flush()
+
+    def _flush(self):
+        if not self.pending:
+            return
+        self.file.write("".join(json.dumps(e) + "\n" for e in self.pending))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = []
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.file.close()
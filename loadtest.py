@@ -0,0 +1,176 @@
+from firefly import Firefly
+from main import makeImporter, formatSummary
+from memo import DescriptorCache
+from mockserver import MockFirefly, MockServer
+import datetime
+import io
+import random
+import time
+
+OWN_IBAN = "CH9300762011623852957"
+
+UBS_COLUMNS = ["Abschlussdatum", "Abschlusszeit", "Buchungsdatum", "Valutadatum", "Währung", "Belastung",
+               "Gutschrift", "Einzelbetrag", "Saldo", "Transaktions-Nr.", "Beschreibung1", "Beschreibung2",
+               "Beschreibung3", "Fussnoten"]
+
+
+def _csvLine(cells):
+    values = [cells.get(c, "") for c in UBS_COLUMNS]
+    return ";".join('"{}"'.format(v) if ";" in v else v for v in values)
+
+
+def generateUbsStatement(rows, counterparties=50, seed=None):
+    """
+    Generates a UBS account statement (CSV, as bytes) with a mix of IBAN payments to a fixed
+    set of counterparties, TWINT payments, plain card purchases and batches of standing orders.
+    """
+    rnd = random.Random(seed)
+    ibans = ["CH{:02d}{:017d}".format(rnd.randint(10, 99), rnd.randint(0, 10 ** 17 - 1)) for _ in range(counterparties)]
+    day = datetime.date(2024, 1, 1)
+    lines = [
+        "Kontonummer:;0000 00000000.0",
+        "IBAN:;{}".format(OWN_IBAN),
+        "",
+        ";".join(UBS_COLUMNS),
+    ]
+    i = 0
+    while i < rows:
+        if rnd.random() < 0.1:
+            day += datetime.timedelta(days=1)
+        if rnd.random() < 0.03 and rows - i >= 3:
+            # "Diverse Daueraufträge": a header row followed by its sub-entries
+            children = []
+            for n in rnd.sample(range(counterparties), 3):
+                children.append({
+                    "Einzelbetrag": "-{:.2f}".format(rnd.uniform(50, 2000)),
+                    "Transaktions-Nr.": "LT{:012d}".format(i),
+                    "Beschreibung1": "Counterparty {}".format(n),
+                    "Beschreibung3": "Konto-Nr. IBAN: {}; Zahlungsgrund: Standing order".format(ibans[n]),
+                })
+                i += 1
+            total = sum(float(c["Einzelbetrag"]) for c in children)
+            header = {
+                "Abschlussdatum": day.isoformat(),
+                "Belastung": "{:.2f}".format(total),
+                "Transaktions-Nr.": "LB{:012d}".format(i),
+                "Beschreibung1": "Diverse Daueraufträge",
+            }
+            for cells in [header] + children:
+                lines.append(_csvLine(cells))
+            continue
+        amount = "{:.2f}".format(rnd.uniform(1, 500))
+        credit = rnd.random() < 0.2
+        kind = rnd.random()
+        if kind < 0.6:
+            n = rnd.randrange(counterparties)
+            description1 = "Counterparty {}".format(n)
+            description3 = "Konto-Nr. IBAN: {}; Zahlungsgrund: Invoice {}".format(ibans[n], i)
+        elif kind < 0.85:
+            description1 = "Merchant {}; Zahlung UBS TWINT".format(rnd.randrange(counterparties))
+            description3 = "Zahlungsgrund: Merchant; TWINT-Acc.:+41790000000"
+        else:
+            description1 = "Shop {} Zurich".format(rnd.randrange(counterparties))
+            description3 = ""
+        cells = {
+            "Abschlussdatum": day.isoformat(),
+            "Belastung": "" if credit else "-" + amount,
+            "Gutschrift": amount if credit else "",
+            "Transaktions-Nr.": "LT{:012d}".format(i),
+            "Beschreibung1": description1,
+            "Beschreibung2": "",
+            "Beschreibung3": description3,
+        }
+        lines.append(_csvLine(cells))
+        i += 1
+    return "\n".join(lines).encode()
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run(rows=1000, counterparties=50, jobs=4, lean=False, optimistic=False, passes=1, seed=None, nameThreshold=None,
+        group=False, **mockOptions):
+    mock = MockFirefly(seed=seed, **mockOptions)
+    descriptors = DescriptorCache()
+    mock.addAccount("Checking", 'asset', OWN_IBAN)
+    server = MockServer(mock).start()
+    try:
+        statement = generateUbsStatement(rows, counterparties, seed)
+        firefly = Firefly(server.url, "token", jobs, lean)
+        start = time.monotonic()
+        for i in range(passes):
+            ffi = makeImporter(firefly, "ubs", "statement.csv", jobs=jobs, optimistic=optimistic,
+                               nameThreshold=nameThreshold, group=group, descriptorCache=descriptors)
+            summary = ffi.process(io.BytesIO(statement))
+            print("Pass {}: {}".format(i + 1, formatSummary(summary)))
+        elapsed = time.monotonic() - start
+    finally:
+        server.stop()
+
+    stats = mock.stats()
+    latencies = firefly.governor.latencies
+    imported = sum(len(g['transactions']) for g in mock.transactions.values())
+    print("Rows: {} x {} passes, imported: {}, elapsed: {:.2f}s".format(rows, passes, imported, elapsed))
+    # the two differ if anything below the governor retries on its own
+    print("Requests: {} ({:.1f}/s, {:.2f} per imported row), sent by the governor: {}, retries: {}, injected: {}".format(
+        stats['requests'], stats['requests'] / elapsed, stats['requests'] / max(imported, 1),
+        firefly.governor.requests, firefly.governor.retries, stats['injected']))
+    for (method, route), count in sorted(stats['byEndpoint'].items(), key=lambda i: -i[1]):
+        print("  {:5} {:40} {}".format(method, route, count))
+    governor = firefly.governor.stats()
+    print("Concurrency limit: mean {:.2f}, final {}, overloads: {}".format(
+        governor['meanLimit'], governor['limit'], governor['overloads']))
+    print("Descriptor cache: {hits} hits, {misses} misses".format(**descriptors.stats()))
+    print("Latency (client) p50: {:.1f}ms p95: {:.1f}ms p99: {:.1f}ms max: {:.1f}ms".format(
+        *(1000 * percentile(latencies, p) for p in (50, 95, 99, 100))))
+    print("Latency (server) p50: {:.1f}ms p95: {:.1f}ms p99: {:.1f}ms max: {:.1f}ms".format(
+        *(1000 * percentile(stats['durations'], p) for p in (50, 95, 99, 100))))
+    return stats
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    op = OptionParser()
+    op.add_option('-n', '--rows', dest='rows', type='int',
+                      help="Number of statement rows to generate", default=1000)
+    op.add_option('-c', '--counterparties', dest='counterparties', type='int',
+                      help="Number of distinct counterparties", default=50)
+    op.add_option('-j', '--jobs', dest='jobs', type='int',
+                      help="Maximum number of concurrent requests", default=4)
+    op.add_option('-l', '--lean', dest='lean', action='store_true',
+                      help="Use the lean JSON transport")
+    op.add_option('-o', '--optimistic', dest='optimistic', action='store_true',
+                      help="Use optimistic insert mode")
+    op.add_option('-p', '--passes', dest='passes', type='int',
+                      help="Import the statement this many times (later passes hit the duplicate checks)", default=1)
+    op.add_option('-m', '--match-names', dest='nameThreshold', type='float',
+                      help="Trigram similarity threshold for mapping counterparty names onto accounts")
+    op.add_option('-g', '--group-batches', dest='group', action='store_true',
+                      help="Store batch sub-entries as multi-split transactions")
+    op.add_option('--latency', dest='latency', type='float',
+                      help="Server base latency in seconds", default=0.01)
+    op.add_option('--jitter', dest='jitter', type='float',
+                      help="Additional random server latency in seconds", default=0.01)
+    op.add_option('--capacity', dest='capacity', type='int',
+                      help="Number of requests the server processes in parallel", default=None)
+    op.add_option('--error-rate', dest='errorRate', type='float',
+                      help="Fraction of requests failing with 429/502/503", default=0.0)
+    op.add_option('--retry-after', dest='retryAfter', type='int',
+                      help="Retry-After header (whole seconds) sent with injected errors", default=None)
+    op.add_option('--duplicate-rate', dest='duplicateRate', type='float',
+                      help="Fraction of transaction stores rejected as duplicates", default=0.0)
+    op.add_option('--drop-rate', dest='dropRate', type='float',
+                      help="Fraction of transaction stores dropped by a rule", default=0.0)
+    op.add_option('-s', '--seed', dest='seed', type='int',
+                      help="Random seed", default=None)
+    (opts, args) = op.parse_args()
+
+    run(rows=opts.rows, counterparties=opts.counterparties, jobs=opts.jobs, lean=opts.lean,
+        optimistic=opts.optimistic, passes=opts.passes, seed=opts.seed, nameThreshold=opts.nameThreshold, group=opts.group,
+        latency=opts.latency, jitter=opts.jitter, capacity=opts.capacity, errorRate=opts.errorRate,
+        errorStatuses=(429, 502, 503), retryAfter=opts.retryAfter,
+        duplicateRate=opts.duplicateRate, dropRate=opts.dropRate)
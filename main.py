@@ -1,35 +1,185 @@
-from firefly import Firefly
+from firefly import Firefly, INSERTED, DUPLICATE, DROPPED, SKIPPED
+from journal import ImportJournal
+from memo import DescriptorCache
+from planner import PlanningFirefly
 import parse
 import transform
 import sys
 import datetime
+import io
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 class FFImporter:
-    def __init__(self, parser, transformer, firefly, debug=False):
+    def __init__(self, parser, transformer, firefly, debug=False, jobs=1, optimistic=False, journalDir=None, resume=False,
+                 group=False):
         self.debug = debug
         self.parser = parser
         self.transformer = transformer
         self.firefly = firefly
+        self.jobs = jobs
+        self.optimistic = optimistic
+        self.journalDir = journalDir
+        self.resume = resume
+        self.group = group
+        self.tagCreated = False
     
-    def process(self, filename):
-        parsed = parser.parse(filename)
-        if 'iban' in parsed:
-            transformer.setOwnAccount(parsed['iban'])
+    def process(self, filename, journal=None):
+        if journal:
+            source = parse.HashingReader(filename)
+            parsed = self.parser.parse(io.BufferedReader(source, parse.CHUNK_SIZE))
+            journal.checkInput(source.fingerprint())
+        else:
+            parsed = self.parser.parse(filename)
+        # the same transformer handles every file of a run, nothing may carry over from the last one
+        self.transformer.reset()
 
-        tx = transformer.transform(parsed['tx'])
+        if journal and journal.tag:
+            # resuming: keep the whole import under the tag it was started with
+            self.transformer.tag = journal.tag
+            self.tagCreated = self.tagCreated or journal.tagCreated
 
-        if not self.debug:
-            firefly.createTag(transformer.tag, datetime.date.today())
+        if not (self.debug or self.tagCreated):
+            # all files of one run share the tag
+            self.firefly.createTag(self.transformer.tag, datetime.date.today())
+            self.tagCreated = True
+        if journal:
+            journal.recordTag(self.transformer.tag, self.tagCreated)
 
-        for x in tx:
-            self.firefly.sendTx(x, self.debug)
+        statements = parsed.get('statements', [])
+        if len(statements) <= 1:
+            if 'iban' in parsed:
+                self.transformer.setOwnAccount(parsed['iban'])
+            return self.processStatement(self.transformer, parsed['tx'], journal)
+
+        # one statement per account: each gets its own transformer and they run side by side
+        def processStatement(n):
+            statement = statements[n]
+            if not statement['iban']:
+                print("Statement {} is not for an IBAN account - skipping its {} transactions.".format(n, len(statement['tx'])))
+                return Counter()
+            transformer = self.transformer.clone()
+            transformer.setOwnAccount(statement['iban'])
+            if not transformer.account:
+                print("No asset account with IBAN {} - skipping its {} transactions.".format(statement['iban'], len(statement['tx'])))
+                return Counter()
+            print("Importing statement of {} ({} transactions)".format(statement['iban'], len(statement['tx'])))
+            return self.processStatement(transformer, statement['tx'], journal, "{}:".format(n))
+
+        with ThreadPoolExecutor(max_workers=max(1, min(len(statements), self.jobs))) as pool:
+            return sum(pool.map(processStatement, range(len(statements))), Counter())
+
+    def processStatement(self, transformer, transactions, journal=None, rowPrefix=""):
+        tx = transformer.transform(transactions)
+
+        # each unit is stored as one transaction (group): (group title, row indices)
+        if self.group:
+            units = transformer.group(tx)
+        else:
+            units = [(None, [i]) for i in range(len(tx))]
+        if journal and journal.resumed:
+            # a row is only skipped if it still is the transaction that was confirmed at that position
+            units = [(title, rows) for title, rows in units
+                     if not all(journal.isConfirmed(rowPrefix + str(i), tx[i].external_id) for i in rows)]
+            left = sum(len(rows) for _, rows in units)
+            print("Resuming after {} confirmed rows, {} left.".format(len(tx) - left, left))
+
+        # The server-side duplicate hash covers the whole transaction including our per-run
+        # import tag, so it only catches rows stored by this same import. Rows from earlier
+        # imports can only be dated up to the newest transaction already on the account,
+        # so in optimistic mode only those still get an external ID check.
+        cutoff = None
+        if self.optimistic and not self.debug:
+            latest = self.firefly.getLatestTransactionDate(transformer.account.id)
+            cutoff = latest.date() if latest else None
+
+        def send(unit):
+            title, rows = unit
+            splits = [tx[i] for i in rows]
+            checkExisting = not self.optimistic or (cutoff is not None and min(x.var_date for x in splits).date() <= cutoff)
+            outcomes = self.firefly.sendGroup(splits, title, self.debug, checkExisting)
+            if journal:
+                for i, outcome in zip(rows, outcomes):
+                    if outcome != SKIPPED:
+                        journal.record(rowPrefix + str(i), tx[i].external_id, outcome)
+            return outcomes
+
+        if self.jobs <= 1:
+            results = [send(unit) for unit in units]
+        else:
+            # the firefly request governor decides how many of these are actually in flight
+            with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                results = list(pool.map(send, units))
+
+        return Counter(outcome for outcomes in results for outcome in outcomes)
+
+    def processFile(self, path):
+        summary = Counter()
+        for name, stream in parse.openInputs(path):
+            print("Importing {}".format(name))
+            journal = None
+            if self.journalDir and not self.debug:
+                journal = ImportJournal.forInput(self.journalDir, self.firefly.conf.host, path, name).open(self.resume)
+            try:
+                summary += self.process(stream, journal)
+            finally:
+                if journal:
+                    journal.close()
+        return summary
+
+
+def makeImporter(firefly, bank, filename, iban=None, account=None, debug=False, jobs=1, optimistic=False, nameThreshold=None,
+                 journalDir=None, resume=False, group=False, descriptorCache=None):
+    parser = None
+    if parse.stripCompression(filename).endswith(('.xml', '.zip')):
+        parser = parse.CamtParser()
+
+    transformer = None
+    if bank == "appkb":
+        transformer = transform.AppkbTransformer(firefly, debug)
+    if bank == "zkb":
+        parser = parse.ZkbCsvParser()
+        transformer = transform.ZkbTransformer(firefly, debug)
+        if not iban:
+            raise ValueError("Please provide IBAN")
+        transformer.setOwnAccount(iban)
+    if bank == "viseca":
+        parser = parse.VisecaCsvParser()
+        transformer = transform.VisecaTransformer(firefly, debug)
+        if not account:
+            raise ValueError("Please provide account name")
+        transformer.setOwnAccount(account, iban=False)
+    if bank == "ubs":
+        parser = parse.UbsCsvParser()
+        transformer = transform.UbsTransformer(firefly, debug)
+    if bank == "ubscard":
+        parser = parse.UbsCardCsvParser()
+        transformer = transform.UbsCardTransformer(firefly, debug)
+        if not account:
+            raise ValueError("Please provide account name")
+        transformer.setOwnAccount(account, iban=False)
+    if not (transformer and parser):
+        raise ValueError("Invalid input")
+        # todo better errors
+
+    if nameThreshold:
+        transformer.setNameIndexes(firefly.getExpenseNameIndex(nameThreshold), firefly.getRevenueNameIndex(nameThreshold))
+    if descriptorCache is not None:
+        transformer.setDescriptorCache(descriptorCache)
+
+    return FFImporter(parser, transformer, firefly, debug, jobs, optimistic, journalDir, resume, group)
+
+
+def formatSummary(summary):
+    return "Inserted: {}, duplicates: {}, dropped by rules: {}".format(
+        summary[INSERTED], summary[DUPLICATE], summary[DROPPED])
 
 
 if __name__ == '__main__':
     from optparse import OptionParser
     op = OptionParser()
     op.add_option('-f', '--file', dest='file', type='string',
-                      help="Path of bank statement file")
+                      help="Path of bank statement file, may be gzip/bz2/xz compressed or a zip archive of statements")
     op.add_option('-H', '--host', dest='host', type='string',
                       help="Firefly host", default="https://mani.tetrahedron.ch/api")
     op.add_option('-t', '--token', dest='token', type='string',
@@ -42,41 +192,60 @@ if __name__ == '__main__':
                       help="Name of account associated with bank statement")
     op.add_option('-d', '--debug', dest='debug', action='store_true',
                       help="Debug mode")
+    op.add_option('-j', '--jobs', dest='jobs', type='int',
+                      help="Maximum number of concurrent requests to Firefly", default=1)
+    op.add_option('-l', '--lean', dest='lean', action='store_true',
+                      help="Use the lean JSON transport for searches and transaction stores")
+    op.add_option('-o', '--optimistic', dest='optimistic', action='store_true',
+                      help="Skip the external ID check for rows newer than the account's latest transaction")
+    op.add_option('-m', '--match-names', dest='nameThreshold', type='float',
+                      help="Map counterparty names onto existing accounts with at least this trigram similarity (0-1)")
+    op.add_option('-J', '--journal-dir', dest='journalDir', type='string',
+                      help="Directory for import journals", default=".import-journal")
+    op.add_option('-r', '--resume', dest='resume', action='store_true',
+                      help="Resume an interrupted import of the same file from its journal")
+    op.add_option('-g', '--group-batches', dest='group', action='store_true',
+                      help="Store the sub-entries of a bank batch as one multi-split transaction")
+    op.add_option('--descriptor-cache', dest='descriptorCache', type='string',
+                      help="File to keep parsed booking texts in between runs")
+    op.add_option('-P', '--plan', dest='plan', action='store_true',
+                      help="Only estimate the requests and time the import would take, without storing anything")
+    op.add_option('--store-latency', dest='storeLatency', type='float',
+                      help="Seconds a store takes on the server, for --plan (default: the measured search latency)")
     (opts, args) = op.parse_args()
 
-    firefly = Firefly(opts.host, opts.token)
+    if opts.plan and opts.debug:
+        # debug transforms use dummy accounts instead of creating them, the plan would miss those requests
+        sys.exit("--plan can't be combined with --debug")
 
-    parser = None
-    if opts.file.endswith('.xml'):
-        parser = parse.CamtParser()
+    if opts.plan:
+        firefly = PlanningFirefly(opts.host, opts.token, opts.jobs, opts.lean)
+        # nothing gets stored, so there is nothing to journal
+        opts.journalDir = None
+    else:
+        firefly = Firefly(opts.host, opts.token, opts.jobs, opts.lean)
+    descriptors = DescriptorCache()
+    if opts.descriptorCache:
+        descriptors.load(opts.descriptorCache)
 
-    transformer = None
-    if opts.bank == "appkb":
-        transformer = transform.AppkbTransformer(firefly, opts.debug)
-    if opts.bank == "zkb":
-        parser = parse.ZkbCsvParser()
-        transformer = transform.ZkbTransformer(firefly, opts.debug)
-        if not opts.iban:
-            sys.exit("Please provide IBAN")
-        transformer.setOwnAccount(opts.iban)
-    if opts.bank == "viseca":
-        parser = parse.VisecaCsvParser()
-        transformer = transform.VisecaTransformer(firefly, opts.debug)
-        if not opts.account:
-            sys.exit("Please provide account name")
-        transformer.setOwnAccount(opts.account, iban=False)
-    if opts.bank == "ubs":
-        parser = parse.UbsCsvParser()
-        transformer = transform.UbsTransformer(firefly, opts.debug)
-    if opts.bank == "ubscard":
-        parser = parse.UbsCardCsvParser()
-        transformer = transform.UbsCardTransformer(firefly, opts.debug)
-        if not opts.account:
-            sys.exit("Please provide account name")
-        transformer.setOwnAccount(opts.account, iban=False)
-    if not (transformer and parser):
-        sys.exit("Invalid input")
-        # todo better errors
-    
-    ffi = FFImporter(parser, transformer, firefly, opts.debug)
-    ffi.process(opts.file)
+    try:
+        ffi = makeImporter(firefly, opts.bank, opts.file, opts.iban, opts.account,
+                           opts.debug, opts.jobs, opts.optimistic, opts.nameThreshold, opts.journalDir, opts.resume,
+                           opts.group, descriptors)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    try:
+        summary = ffi.processFile(opts.file)
+    except ValueError as e:
+        sys.exit(str(e))
+    if opts.plan:
+        print(firefly.report(opts.jobs, opts.storeLatency))
+    else:
+        print(formatSummary(summary))
+    if opts.descriptorCache:
+        # dry runs leave the cache file alone, like the journal
+        if not (opts.debug or opts.plan):
+            descriptors.save(opts.descriptorCache)
+        stats = descriptors.stats()
+        print("Descriptor cache: {} hits, {} misses".format(stats['hits'], stats['misses']))
@@ -0,0 +1,61 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+
+
+class DescriptorCache:
+    """
+    Bounded LRU cache of parsed booking texts (counterparty name, notes...), keyed by the
+    parser (transformer, its descriptor version and the kind of text) and the raw text.
+
+    Values must be JSON serializable so the cache can be kept on disk between runs.
+    """
+
+    def __init__(self, maxSize=10000):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, parser, text, parse):
+        key = (parser, text)
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+        value = parse(text)
+        with self.lock:
+            self.entries[key] = value
+            if len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+        return value
+
+    def load(self, path):
+        if not os.path.exists(path):
+            return self
+        with open(path) as f:
+            for parser, text, value in json.load(f):
+                self.entries[(parser, text)] = value
+        while len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+        return self
+
+    def save(self, path):
+        with self.lock:
+            entries = [[parser, text, value] for (parser, text), value in self.entries.items()]
+        tmp = path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp, path)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.entries),
+            }
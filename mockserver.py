@@ -0,0 +1,326 @@
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from utils import normalizeIban
+
+DUPLICATE_MESSAGE = "Duplicate of transaction #{}."
+RULE_DROP_MESSAGE = "Possibly, a rule deleted this transaction after its creation."
+
+
+class MockFirefly:
+    """
+    In-memory stand-in for the parts of the Firefly III API the importer uses.
+
+    Every request is delayed by latency (+ up to jitter) seconds, at most capacity requests are
+    processed at a time (the rest queue up, as on a real server), and errorRate of all requests
+    fail with one of errorStatuses. Of the transaction stores, duplicateRate are rejected as
+    duplicates and dropRate as deleted by a rule, on top of real duplicate hash detection.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, capacity=None, errorRate=0.0, errorStatuses=(429, 503),
+                 retryAfter=None, duplicateRate=0.0, dropRate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.errorStatuses = errorStatuses
+        self.retryAfter = retryAfter
+        self.duplicateRate = duplicateRate
+        self.dropRate = dropRate
+        self.random = random.Random(seed)
+        self.slots = threading.Semaphore(capacity) if capacity else None
+
+        self.lock = threading.Lock()
+        self.nextId = 1
+        self.accounts = {}
+        self.tags = {}
+        self.transactions = {}
+        self.externalIds = {}
+        self.hashes = {}
+
+        self.requests = Counter()
+        self.injected = Counter()
+        self.durations = []
+
+    def _newId(self):
+        i = self.nextId
+        self.nextId += 1
+        return str(i)
+
+    def addAccount(self, name, atype, iban=None):
+        with self.lock:
+            return self._addAccount(name, atype, iban)
+
+    def _addAccount(self, name, atype, iban=None):
+        account = {
+            'id': self._newId(),
+            'name': name,
+            'type': atype,
+            'iban': normalizeIban(iban) if iban else None,
+        }
+        self.accounts[account['id']] = account
+        return account
+
+    def handle(self, method, path, query, body):
+        """Returns (status, headers, body) for one request."""
+        start = time.monotonic()
+        route = re.sub(r"/\d+/", "/{id}/", path)
+        if self.slots:
+            self.slots.acquire()
+        try:
+            time.sleep(self.latency + self.random.uniform(0, self.jitter))
+            with self.lock:
+                self.requests[(method, route)] += 1
+                if self.random.random() < self.errorRate:
+                    status = self.random.choice(self.errorStatuses)
+                    self.injected[status] += 1
+                    # HTTP only allows whole seconds (or a date) here
+                    headers = {'Retry-After': str(math.ceil(self.retryAfter))} if self.retryAfter is not None else {}
+                    return status, headers, {'message': 'Injected error'}
+                return self._dispatch(method, route, path, query, body)
+        finally:
+            if self.slots:
+                self.slots.release()
+            with self.lock:
+                self.durations.append(time.monotonic() - start)
+
+    def _dispatch(self, method, route, path, query, body):
+        if (method, route) == ('POST', '/api/v1/tags'):
+            return self.storeTag(body)
+        if (method, route) == ('GET', '/api/v1/search/accounts'):
+            return self.searchAccounts(query)
+        if (method, route) == ('GET', '/api/v1/accounts'):
+            return self.listAccounts(query)
+        if (method, route) == ('POST', '/api/v1/accounts'):
+            return self.storeAccount(body)
+        if (method, route) == ('GET', '/api/v1/search/transactions'):
+            return self.searchTransactions(query)
+        if (method, route) == ('POST', '/api/v1/transactions'):
+            return self.storeTransaction(body)
+        if (method, route) == ('GET', '/api/v1/accounts/{id}/transactions'):
+            return self.listAccountTransactions(path.split('/')[-2], query)
+        return 404, {}, {'message': 'Resource not found'}
+
+    @staticmethod
+    def _array(data, page=1, limit=None):
+        limit = limit or max(len(data), 1)
+        totalPages = max(1, -(-len(data) // limit))
+        pageData = data[(page - 1) * limit:page * limit]
+        return {
+            'data': pageData,
+            'meta': {'pagination': {'total': len(data), 'count': len(pageData), 'per_page': limit,
+                                    'current_page': page, 'total_pages': totalPages}},
+            'links': {},
+        }
+
+    @staticmethod
+    def _accountRead(account):
+        return {
+            'type': 'accounts',
+            'id': account['id'],
+            'attributes': {
+                'name': account['name'],
+                'type': account['type'],
+                'iban': account['iban'],
+            },
+            'links': {},
+        }
+
+    def _transactionRead(self, group):
+        return {
+            'type': 'transactions',
+            'id': group['id'],
+            'attributes': {
+                'group_title': group['group_title'],
+                'transactions': group['transactions'],
+            },
+            'links': {},
+        }
+
+    def storeTag(self, body):
+        if body['tag'] in self.tags:
+            return 422, {}, {'message': 'The given data was invalid.', 'errors': {'tag': ['This tag is already in use.']}}
+        tag = {'type': 'tags', 'id': self._newId(), 'attributes': {'tag': body['tag'], 'date': body.get('date')}, 'links': {}}
+        self.tags[body['tag']] = tag
+        return 200, {}, {'data': tag}
+
+    def searchAccounts(self, query):
+        identifier = query['query'][0]
+        field = query.get('field', ['all'])[0]
+        atype = query.get('type', ['all'])[0]
+        found = []
+        for account in self.accounts.values():
+            if atype != 'all' and account['type'] != atype:
+                continue
+            if field == 'iban' and account['iban'] == normalizeIban(identifier):
+                found.append(account)
+            elif field != 'iban' and identifier.lower() in account['name'].lower():
+                found.append(account)
+        return 200, {}, self._array([self._accountRead(a) for a in found])
+
+    def listAccounts(self, query):
+        atype = query.get('type', ['all'])[0]
+        found = [a for a in self.accounts.values() if atype == 'all' or a['type'] == atype]
+        page = int(query.get('page', [1])[0])
+        limit = int(query.get('limit', [50])[0])
+        return 200, {}, self._array([self._accountRead(a) for a in found], page, limit)
+
+    def storeAccount(self, body):
+        for account in self.accounts.values():
+            if account['type'] == body['type'] and account['name'] == body['name']:
+                return 422, {}, {'message': 'This account name is already in use.', 'errors': {'name': ['This account name is already in use.']}}
+        account = self._addAccount(body['name'], body['type'], body.get('iban'))
+        return 200, {}, {'data': self._accountRead(account)}
+
+    def searchTransactions(self, query):
+        q = query['query'][0]
+        found = []
+        if q.startswith('external_id:'):
+            externalId = q[len('external_id:'):]
+            found = [self.transactions[i] for i in self.externalIds.get(externalId, [])]
+        return 200, {}, self._array([self._transactionRead(g) for g in found])
+
+    def _resolveParty(self, split, side, atype):
+        accountId = split.get(side + '_id')
+        if accountId and accountId in self.accounts:
+            return self.accounts[accountId]
+        name = split.get(side + '_name') or "(no name)"
+        for account in self.accounts.values():
+            if account['type'] == atype and account['name'] == name:
+                return account
+        return self._addAccount(name, atype)
+
+    def storeTransaction(self, body):
+        digest = hashlib.sha256(json.dumps(body['transactions'], sort_keys=True).encode()).hexdigest()
+        if body.get('error_if_duplicate_hash'):
+            if digest in self.hashes:
+                return 422, {}, {'message': DUPLICATE_MESSAGE.format(self.hashes[digest]),
+                                 'errors': {'transactions.0.description': [DUPLICATE_MESSAGE.format(self.hashes[digest])]}}
+            if self.random.random() < self.duplicateRate:
+                self.injected['duplicate'] += 1
+                return 422, {}, {'message': DUPLICATE_MESSAGE.format(0),
+                                 'errors': {'transactions.0.description': [DUPLICATE_MESSAGE.format(0)]}}
+        if self.random.random() < self.dropRate:
+            self.injected['dropped'] += 1
+            return 500, {}, {'message': RULE_DROP_MESSAGE, 'exception': 'FireflyException'}
+
+        splits = []
+        for split in body['transactions']:
+            sourceType = 'revenue' if split['type'] == 'deposit' else 'asset'
+            destinationType = 'expense' if split['type'] == 'withdrawal' else 'asset'
+            source = self._resolveParty(split, 'source', sourceType)
+            destination = self._resolveParty(split, 'destination', destinationType)
+            splits.append({
+                **split,
+                'source_id': source['id'],
+                'source_name': source['name'],
+                'destination_id': destination['id'],
+                'destination_name': destination['name'],
+            })
+        group = {
+            'id': self._newId(),
+            'group_title': body.get('group_title'),
+            'transactions': splits,
+        }
+        self.transactions[group['id']] = group
+        for split in splits:
+            if split.get('external_id'):
+                self.externalIds.setdefault(split['external_id'], []).append(group['id'])
+        self.hashes[digest] = group['id']
+        return 200, {}, {'data': self._transactionRead(group)}
+
+    def listAccountTransactions(self, accountId, query):
+        found = [g for g in self.transactions.values()
+                 if any(accountId in (s['source_id'], s['destination_id']) for s in g['transactions'])]
+        found.sort(key=lambda g: g['transactions'][0]['date'], reverse=True)
+        limit = int(query.get('limit', [50])[0])
+        return 200, {}, self._array([self._transactionRead(g) for g in found[:limit]])
+
+    def stats(self):
+        with self.lock:
+            return {
+                'requests': sum(self.requests.values()),
+                'byEndpoint': dict(self.requests),
+                'injected': dict(self.injected),
+                'durations': list(self.durations),
+            }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, don't let Nagle + delayed ACK add 40ms to every response
+    disable_nagle_algorithm = True
+
+    def _handle(self, method):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        status, headers, payload = self.server.mock.handle(method, url.path, parse_qs(url.query), body)
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockServer:
+    """Serves a MockFirefly over HTTP from a background thread."""
+
+    def __init__(self, mock, port=0):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.mock = mock
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/api".format(self.httpd.server_address[1])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    op = OptionParser()
+    op.add_option('-p', '--port', dest='port', type='int',
+                      help="Port to listen on", default=8080)
+    op.add_option('--latency', dest='latency', type='float',
+                      help="Base latency per request in seconds", default=0.0)
+    op.add_option('--error-rate', dest='errorRate', type='float',
+                      help="Fraction of requests failing with 429/503", default=0.0)
+    op.add_option('-i', '--iban', dest='iban', type='string',
+                      help="IBAN of an asset account to create up front")
+    (opts, args) = op.parse_args()
+
+    mock = MockFirefly(latency=opts.latency, errorRate=opts.errorRate)
+    if opts.iban:
+        mock.addAccount("Checking", 'asset', opts.iban)
+    server = MockServer(mock, opts.port)
+    print("Mock Firefly listening on {}".format(server.url))
+    server.httpd.serve_forever()
@@ -0,0 +1,84 @@
+import re
+import threading
+import unicodedata
+from collections import Counter
+
+
+def normalizeName(name):
+    """'COOP-1234 ZÜRICH' and 'Coop 1234 Zurich' both become 'coop 1234 zurich'."""
+    name = unicodedata.normalize('NFKD', name)
+    name = "".join(c for c in name if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[\W_]+", " ", name.casefold()).split())
+
+
+def trigrams(normalized):
+    padded = "  {} ".format(normalized)
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex:
+    """
+    Fuzzy lookup of account names by trigram similarity (Jaccard, as in pg_trgm).
+
+    Names added without an account id stand for accounts Firefly will create on the fly
+    from a free-text name; later spellings of the same counterparty get mapped to the first one.
+    """
+
+    def __init__(self, threshold=0.8):
+        self.threshold = threshold
+        self.entries = []
+        self.exact = {}
+        self.postings = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, accountId=None):
+        with self.lock:
+            self._add(name, accountId)
+
+    def _add(self, name, accountId):
+        normalized = normalizeName(name)
+        if not normalized or normalized in self.exact:
+            # names without letters or digits all look the same, don't match anything onto them
+            return
+        grams = trigrams(normalized)
+        self.exact[normalized] = len(self.entries)
+        for g in grams:
+            self.postings.setdefault(g, []).append(len(self.entries))
+        self.entries.append((name, accountId, len(grams)))
+
+    def match(self, name):
+        """Returns (name, account id or None) of the closest known name, or None if nothing is close enough."""
+        normalized = normalizeName(name)
+        if not normalized:
+            return None
+        with self.lock:
+            if normalized in self.exact:
+                entry = self.entries[self.exact[normalized]]
+                return entry[0], entry[1]
+
+            grams = trigrams(normalized)
+            shared = Counter()
+            for g in grams:
+                shared.update(self.postings.get(g, ()))
+            best, bestScore = None, 0.0
+            for i, common in shared.items():
+                score = common / (len(grams) + self.entries[i][2] - common)
+                if score > bestScore:
+                    best, bestScore = i, score
+            if best is None or bestScore < self.threshold:
+                return None
+            entry = self.entries[best]
+            return entry[0], entry[1]
+
+    def resolve(self, name):
+        """
+        Like match, but remembers unknown names so later variants resolve to them.
+        None for names without letters or digits.
+        """
+        if not normalizeName(name):
+            return None
+        found = self.match(name)
+        if found:
+            return found
+        self.add(name)
+        return name, None
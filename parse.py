@@ -1,8 +1,24 @@
 from pycamt import parser as camtparser
+import bz2
 import csv
+import gzip
+import hashlib
+import io
+import lzma
+import os
+import re
+import zipfile
 
 from utils import normalizeIban
 
+CHUNK_SIZE = 64 * 1024
+
+DECOMPRESSORS = {
+    '.gz': gzip,
+    '.bz2': bz2,
+    '.xz': lzma,
+}
+
 
 # behold, monkey patching:
 def my_extract_transaction_details(self, tx_detail):
@@ -115,11 +131,14 @@ def my_extract_transaction(self, entry):
 
             # Handle 1-n relationship
             else:
+                # keep the entry's own reference, so the batch can be folded back together later
+                batch_ref = entry.find("./AcctSvcrRef", self.namespaces)
                 for tx_detail in tx_details:
                     transactions.append(
                         {
                             **common_data,
                             **self._extract_transaction_details(tx_detail),
+                            "BatchReference": batch_ref.text if batch_ref is not None else None,
                         }
                     )
     return transactions
@@ -127,6 +146,91 @@ def my_extract_transaction(self, entry):
 camtparser.Camt053Parser._extract_transaction_details = my_extract_transaction_details
 camtparser.Camt053Parser._extract_transaction = my_extract_transaction
 
+def stripCompression(name):
+    root, ext = os.path.splitext(name)
+    if ext.lower() in DECOMPRESSORS:
+        return root
+    return name
+
+def _decompress(name, source):
+    # source is either the path itself or an already open binary stream called name
+    ext = os.path.splitext(name)[1].lower()
+    if ext in DECOMPRESSORS:
+        return DECOMPRESSORS[ext].open(source, 'rb')
+    if hasattr(source, 'read'):
+        return source
+    return open(source, 'rb')
+
+def openInputs(path):
+    """
+    Yields a (name, binary stream) pair for every statement in path.
+
+    Plain and gzip/bz2/xz compressed files yield themselves, zip archives yield each of their
+    (possibly compressed) members. Everything is decompressed on the fly while it is read,
+    names are returned without the compression suffix.
+    """
+    if os.path.splitext(path)[1].lower() == '.zip':
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                with archive.open(info) as member:
+                    yield stripCompression(info.filename), _decompress(info.filename, member)
+    else:
+        with _decompress(path, path) as f:
+            yield stripCompression(path), f
+
+def _openBinary(inFile):
+    if hasattr(inFile, 'read'):
+        return inFile
+    return _decompress(inFile, inFile)
+
+def _openText(inFile, encoding=None):
+    return io.TextIOWrapper(_openBinary(inFile), encoding=encoding, newline='')
+
+def _camtFromStream(stream):
+    # feed the XML to the parser as it is decompressed instead of reading it into one big string,
+    # then hand the tree to pycamt the way its constructor would
+    xmlparser = camtparser.ET.XMLParser()
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+        xmlparser.feed(chunk)
+    parser = camtparser.Camt053Parser.__new__(camtparser.Camt053Parser)
+    parser.tree = xmlparser.close()
+    ns = re.match(r"\{(.+)\}", parser.tree.tag)
+    parser.namespaces = {'': ns.group(1)} if ns else {}
+    parser.version = parser._detect_version()
+    return parser
+
+class HashingReader(io.RawIOBase):
+    """
+    Passes a (decompressed) input through while hashing it, so the parser's single read
+    also yields a fingerprint of what was imported.
+    """
+
+    def __init__(self, inFile):
+        self.source = _openBinary(inFile)
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.source.read(len(b))
+        n = len(data)
+        b[:n] = data
+        self.hash.update(data)
+        self.size += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.source.close()
+        super().close()
+
+    def fingerprint(self):
+        return "{}:{}".format(self.size, self.hash.hexdigest())
+
 class BaseParser:
     @staticmethod
     def parse(inFile):
@@ -135,20 +239,32 @@ class BaseParser:
 class CamtParser(BaseParser):
     @staticmethod
     def parse(inFile):
-        with open(inFile) as camtfile:
-            parser = camtparser.Camt053Parser(camtfile.read())
+        with _openBinary(inFile) as camtfile:
+            parser = _camtFromStream(camtfile)
             iban = parser.get_statement_info()['IBAN']
-            tx = parser.get_transactions()
+            # files covering several accounts have one Stmt per account; every entry is extracted
+            # once, the file's transactions are all the statements' ones
+            statements = []
+            for stmt in parser.tree.findall(".//Stmt", parser.namespaces):
+                stmt_iban = stmt.find(".//Acct//Id//IBAN", parser.namespaces)
+                stmt_tx = []
+                for entry in stmt.findall(".//Ntry", parser.namespaces):
+                    stmt_tx.extend(parser._extract_transaction(entry))
+                statements.append({
+                    'iban': stmt_iban.text if stmt_iban is not None else None,
+                    'tx': stmt_tx,
+                })
             return {
                 'iban': iban,
-                'tx': tx,
+                'tx': [t for s in statements for t in s['tx']],
+                'statements': statements,
             }
 
 class ZkbCsvParser(BaseParser):
     @staticmethod
     def parse(inFile):
-        with open(inFile, newline='') as csvfile:
-            lines = [ l.strip('\n\r\ufeff') for l in  csvfile.readlines() ]
+        with _openText(inFile) as csvfile:
+            lines = (l.strip('\n\r\ufeff') for l in csvfile)
             reader = csv.DictReader(lines, delimiter=';', quotechar='"')
             tx = [i for i in reader]
             return {
@@ -158,8 +274,8 @@ class ZkbCsvParser(BaseParser):
 class VisecaCsvParser(BaseParser):
     @staticmethod
     def parse(inFile):
-        with open(inFile, newline='') as csvfile:
-            lines = [ l.strip('\n\r\ufeff') for l in  csvfile.readlines() ]
+        with _openText(inFile) as csvfile:
+            lines = (l.strip('\n\r\ufeff') for l in csvfile)
             reader = csv.DictReader(lines, delimiter=',', quotechar='"')
             tx = [i for i in reader]
             return {
@@ -170,10 +286,9 @@ class UbsCsvParser(BaseParser):
     @staticmethod
     def parse(inFile):
         iban = None
-        with open(inFile, newline='') as csvfile:
-            lines = [l.strip('\n\r\ufeff') for l in csvfile.readlines()]
-            while True:
-                line = lines.pop(0)
+        with _openText(inFile) as csvfile:
+            lines = (l.strip('\n\r\ufeff') for l in csvfile)
+            for line in lines:
                 if not line:
                     break
                 cells = line.split(";")
@@ -189,8 +304,8 @@ class UbsCsvParser(BaseParser):
 class UbsCardCsvParser(BaseParser):
     @staticmethod
     def parse(inFile):
-        with open(inFile, newline='', encoding='iso-8859-1') as csvfile:
-            lines = [l.strip('\n\r\ufeff') for l in csvfile.readlines() if l and not l.startswith('sep=;') and not l.startswith(';;')]
+        with _openText(inFile, encoding='iso-8859-1') as csvfile:
+            lines = (l.strip('\n\r\ufeff') for l in csvfile if l and not l.startswith('sep=;') and not l.startswith(';;'))
             reader = csv.DictReader(lines, delimiter=';', quotechar='"')
             return {
                 'tx': [i for i in reader],
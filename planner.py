@@ -0,0 +1,89 @@
+import firefly_iii_client as ff
+import threading
+from collections import Counter
+from types import SimpleNamespace
+
+from firefly import Firefly, SKIPPED
+
+CONCURRENCY_LEVELS = (1, 2, 4, 8, 16)
+
+
+class PlanningFirefly(Firefly):
+    """
+    Firefly client for dry runs that tell what an import would cost.
+
+    Reads (account searches, name index listings, the latest transaction of an account) go to
+    the server as usual, which also measures its latency. Writes are only counted: created
+    accounts get a placeholder, so later lookups hit the cache like they would in a real run,
+    and sendGroup records the external ID checks and stores it would make without making them.
+    """
+
+    def __init__(self, host, token, maxInFlight=1, lean=False):
+        super().__init__(host, token, maxInFlight, lean)
+        self.planned = Counter()
+        # external ID checks per transaction (group); the groups are sent side by side
+        self.units = []
+        self.counterparties = set()
+        self._planLock = threading.Lock()
+
+    def createTag(self, tag, date):
+        with self._planLock:
+            self.planned['tags'] += 1
+
+    def createAccount(self, iban, name, atype):
+        with self._createLock:
+            key = (iban, atype.value, ff.AccountSearchFieldFilter.IBAN.value)
+            with self._cacheLock:
+                account = self.accountCache.get(key)
+                if account:
+                    return account
+                self.planned['accounts'] += 1
+                account = SimpleNamespace(id="planned-{}".format(self.planned['accounts']))
+                self.accountCache[key] = account
+            return account
+
+    def sendGroup(self, txSplits, title=None, debug=False, checkExisting=True):
+        checks = sum(1 for s in txSplits if s.external_id) if checkExisting else 0
+        with self._planLock:
+            self.planned['checks'] += checks
+            self.planned['stores'] += 1
+            self.planned['splits'] += len(txSplits)
+            self.units.append(checks)
+            for s in txSplits:
+                if s.type.value == 'withdrawal':
+                    self.counterparties.add(('expense', s.destination_id or s.destination_name))
+                elif s.type.value == 'deposit':
+                    self.counterparties.add(('revenue', s.source_id or s.source_name))
+        return [SKIPPED] * len(txSplits)
+
+    def estimate(self, concurrency, readLatency, writeLatency):
+        """Seconds the import would take with this many requests in flight, if latency stays flat."""
+        # lookups happen while transforming, one row after the other
+        setup = self.governor.requests * readLatency + (self.planned['tags'] + self.planned['accounts']) * writeLatency
+        costs = [checks * readLatency + writeLatency for checks in self.units]
+        if not costs:
+            return setup
+        return setup + max(max(costs), sum(costs) / concurrency)
+
+    def report(self, jobs=1, storeLatency=None):
+        planned = self.planned
+        lines = [
+            "Transactions: {} ({} splits), unique counterparties: {}".format(
+                planned['stores'], planned['splits'], len(self.counterparties)),
+            "Account lookups: {} cache hits, {} misses (searches)".format(self.cacheHits, self.cacheMisses),
+            "Requests: {} reads made while planning, {} tags, {} account creations, {} duplicate checks, {} stores".format(
+                self.governor.requests, planned['tags'], planned['accounts'], planned['checks'], planned['stores']),
+        ]
+        readLatency = self.governor.meanLatency()
+        if readLatency is None:
+            lines.append("No requests were made, can't estimate the duration.")
+            return "\n".join(lines)
+        writeLatency = storeLatency if storeLatency is not None else readLatency
+        lines.append("Total: {} requests, measured latency {:.1f}ms, assumed store latency {:.1f}ms".format(
+            self.governor.requests + planned['tags'] + planned['accounts'] + planned['checks'] + planned['stores'],
+            1000 * readLatency, 1000 * writeLatency))
+        for concurrency in sorted(set(CONCURRENCY_LEVELS) | {jobs}):
+            lines.append("  {:3} in flight: {:.1f}s{}".format(
+                concurrency, self.estimate(concurrency, readLatency, writeLatency),
+                " (selected)" if concurrency == jobs else ""))
+        return "\n".join(lines)
@@ -0,0 +1,158 @@
+from firefly import Firefly
+from main import makeImporter, formatSummary
+from memo import DescriptorCache
+from planner import PlanningFirefly
+import glob
+import json
+import sys
+import traceback
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+# Example config:
+# {
+#   "descriptorCache": ".import-descriptors.json",
+#   "hosts": [
+#     {
+#       "name": "alice",
+#       "host": "https://firefly.example.com/api",
+#       "token": "...",
+#       "concurrency": 4,
+#       "lean": true,
+#       "optimistic": false,
+#       "matchNames": 0.8,
+#       "journalDir": ".import-journal/alice",
+#       "groupBatches": true,
+#       "imports": [
+#         {"bank": "zkb", "iban": "CH9300762011623852957", "files": ["statements/zkb-*.csv.gz"]},
+#         {"bank": "viseca", "account": "Visa", "files": ["statements/viseca.zip"]}
+#       ]
+#     }
+#   ]
+# }
+
+
+class Job:
+    def __init__(self, host, config):
+        self.host = host
+        self.bank = config['bank']
+        self.iban = config.get('iban')
+        self.account = config.get('account')
+        self.files = []
+        for pattern in config['files']:
+            self.files.extend(sorted(glob.glob(pattern)) or [pattern])
+        self.summary = Counter()
+        self.error = None
+
+    def name(self):
+        return "{}/{} ({})".format(self.host.name, self.bank, self.iban or self.account or "from statement")
+
+
+class Host:
+    def __init__(self, config, plan=False):
+        self.name = config.get('name', config['host'])
+        self.concurrency = config.get('concurrency', 1)
+        self.optimistic = config.get('optimistic', False)
+        self.nameThreshold = config.get('matchNames')
+        self.journalDir = None if plan else config.get('journalDir', ".import-journal")
+        self.group = config.get('groupBatches', False)
+        # every host gets its own client, request governor and account cache
+        client = PlanningFirefly if plan else Firefly
+        self.firefly = client(config['host'], config['token'], self.concurrency, config.get('lean', False))
+        self.jobs = [Job(self, i) for i in config['imports']]
+
+
+class Runner:
+    def __init__(self, config, debug=False, resume=False, plan=False):
+        self.debug = debug
+        self.resume = resume
+        self.plan = plan
+        self.hosts = [Host(h, plan) for h in config['hosts']]
+        # parsed booking texts don't depend on the host, all jobs share one cache
+        self.descriptorPath = config.get('descriptorCache')
+        self.descriptors = DescriptorCache()
+        if self.descriptorPath:
+            self.descriptors.load(self.descriptorPath)
+
+    @staticmethod
+    def fromFile(path, debug=False, resume=False, plan=False):
+        with open(path) as f:
+            return Runner(json.load(f), debug, resume, plan)
+
+    def run(self):
+        # one pool per host, so a host's concurrency limit never holds up the others
+        pools = [ThreadPoolExecutor(max_workers=h.concurrency) for h in self.hosts]
+        futures = [pool.submit(self.runJob, j) for h, pool in zip(self.hosts, pools) for j in h.jobs]
+        for f in futures:
+            f.result()
+        for pool in pools:
+            pool.shutdown()
+        # dry runs leave the cache file alone, like the journal
+        if self.descriptorPath and not (self.debug or self.plan):
+            self.descriptors.save(self.descriptorPath)
+        return [j for h in self.hosts for j in h.jobs]
+
+    def runJob(self, job):
+        host = job.host
+        try:
+            ffi = makeImporter(host.firefly, job.bank, job.files[0], job.iban, job.account,
+                               self.debug, host.concurrency, host.optimistic, host.nameThreshold,
+                               host.journalDir, self.resume, host.group, self.descriptors)
+            for path in job.files:
+                job.summary += ffi.processFile(path)
+        except Exception as e:
+            traceback.print_exc()
+            job.error = e
+
+    def report(self, jobs):
+        if self.plan:
+            return self.planReport(jobs)
+        lines = []
+        total = Counter()
+        for job in jobs:
+            if job.error:
+                lines.append("{}: FAILED - {}".format(job.name(), job.error))
+            else:
+                lines.append("{}: {}".format(job.name(), formatSummary(job.summary)))
+            total += job.summary
+        for host in self.hosts:
+            stats = host.firefly.governor.stats()
+            lines.append("{}: {} requests, {} retries, {} account cache hits, {} misses".format(
+                host.name, stats['requests'], stats['retries'], host.firefly.cacheHits, host.firefly.cacheMisses))
+        stats = self.descriptors.stats()
+        lines.append("Descriptor cache: {} hits, {} misses".format(stats['hits'], stats['misses']))
+        lines.append("Total: {}".format(formatSummary(total)))
+        return "\n".join(lines)
+
+    def planReport(self, jobs):
+        lines = ["{}: FAILED - {}".format(j.name(), j.error) for j in jobs if j.error]
+        for host in self.hosts:
+            lines.append("{}:".format(host.name))
+            lines.append(host.firefly.report(host.concurrency))
+        return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    op = OptionParser()
+    op.add_option('-c', '--config', dest='config', type='string',
+                      help="Path of the import config file")
+    op.add_option('-d', '--debug', dest='debug', action='store_true',
+                      help="Debug mode")
+    op.add_option('-r', '--resume', dest='resume', action='store_true',
+                      help="Resume interrupted imports from their journals")
+    op.add_option('-P', '--plan', dest='plan', action='store_true',
+                      help="Only estimate the requests and time the imports would take, without storing anything")
+    (opts, args) = op.parse_args()
+
+    if not opts.config:
+        sys.exit("Please provide a config file")
+    if opts.plan and opts.debug:
+        # debug transforms use dummy accounts instead of creating them, the plan would miss those requests
+        sys.exit("--plan can't be combined with --debug")
+
+    runner = Runner.fromFile(opts.config, opts.debug, opts.resume, opts.plan)
+    jobs = runner.run()
+    print(runner.report(jobs))
+    if any(j.error for j in jobs):
+        sys.exit(1)
@@ -14,33 +14,106 @@ DUMMY_ID = "-1"
 class BaseTransformer:
 
     TAG_SUFFIX = ""
+    # bump whenever a descriptor parser changes its output, so cached descriptors are not reused
+    DESCRIPTOR_VERSION = 1
 
     def __init__(self, firefly, debug=False):
         self.firefly = firefly
         self.debug = debug 
         self.transforms = []
+        self.nameIndexes = None
+        self.descriptors = None
         self.tag = f"import-{datetime.date.today().isoformat()}-{self.TAG_SUFFIX}-{random.randint(10000, 99999)}"
     
     def transform(self, transactions):
         transformed_transactions = []
+        # (key, title) of the bank batch each transformed transaction belongs to, or None
+        self.batches = []
         for tx in transactions:
+            batch = None
             for t in self.transforms:
                 tx = t(tx)
                 if not tx:
                     break
+                if isinstance(tx, dict):
+                    batch = tx.get('batch', batch)
             if tx:
                 transformed_transactions.append(tx)
+                self.batches.append(batch)
         
         return transformed_transactions
+
+    def group(self, transactions):
+        """
+        Folds the splits of each bank batch of the last transform() into one group.
+        Returns (title, [indices]) per group, in order of first appearance.
+        """
+        groups = {}
+        for i, tx in enumerate(transactions):
+            batch = self.batches[i]
+            # splits of one group must share the own account side; transfers may not
+            if batch and tx.type != ff.TransactionTypeProperty.TRANSFER:
+                key = (batch[0], tx.type)
+                title = batch[1]
+            else:
+                key = i
+                title = None
+            groups.setdefault(key, (title, []))[1].append(i)
+        return list(groups.values())
     
+    def reset(self):
+        """Forgets state carried from row to row, before transforming the next input file."""
+        pass
+
+    def clone(self):
+        """A fresh transformer of the same kind sharing tag, account and name indexes, e.g. for another statement."""
+        other = type(self)(self.firefly, self.debug)
+        other.tag = self.tag
+        other.nameIndexes = self.nameIndexes
+        other.descriptors = self.descriptors
+        if hasattr(self, 'account'):
+            other.account = self.account
+        return other
+
     def setOwnAccount(self, identifier, iban=True):
         if iban:
             self.account = self.firefly.getAssetAccountByIban(identifier)
         else:
             self.account = self.firefly.getAssetAccountByName(identifier)
     
+    def setNameIndexes(self, expense, revenue):
+        self.nameIndexes = {
+            ff.TransactionTypeProperty.WITHDRAWAL: expense,
+            ff.TransactionTypeProperty.DEPOSIT: revenue,
+        }
+
+    def setDescriptorCache(self, cache):
+        self.descriptors = cache
+
+    def _describe(self, kind, text, parse):
+        # booking texts repeat a lot (same merchant, same card), parse each distinct one only once
+        if self.descriptors is None:
+            return parse(text)
+        return self.descriptors.get("{}.{}.{}".format(type(self).__name__, self.DESCRIPTOR_VERSION, kind), text, parse)
+
     def unpackTransform(self, tx):
         return tx['firefly']
+
+    def nameMatchTransform(self, fftx):
+        # map free-text counterparty names onto existing expense/revenue accounts
+        if not self.nameIndexes or fftx.type not in self.nameIndexes:
+            return fftx
+        index = self.nameIndexes[fftx.type]
+        if fftx.type == ff.TransactionTypeProperty.WITHDRAWAL:
+            if not fftx.destination_id and fftx.destination_name:
+                resolved = index.resolve(fftx.destination_name)
+                if resolved:
+                    fftx.destination_name, fftx.destination_id = resolved
+        elif not fftx.source_id and fftx.source_name:
+            resolved = index.resolve(fftx.source_name)
+            if resolved:
+                fftx.source_name, fftx.source_id = resolved
+        return fftx
     
     def tagTransform(self, tx):
         if tx.tags:
@@ -77,6 +150,7 @@ class AppkbTransformer(BaseTransformer):
             self.debitCardTransform,
             self.twintTransform,
             self.unpackTransform,
+            self.nameMatchTransform,
             self.tagTransform,
         ]
     
@@ -89,6 +163,9 @@ class AppkbTransformer(BaseTransformer):
             'camt': camt,
         }
 
+        if camt.get('BatchReference'):
+            newData['batch'] = (camt['BatchReference'], camt['AdditionalEntryInformation'])
+
         ex_id = camt.get('AccountServicerReference', "{}.{}.{}".format(camt['BookingDate'], camt['Amount'], camt['TransactionFamilyCode']))
         tx = ff.TransactionSplitStore(
             amount=camt['Amount'],
@@ -160,36 +237,56 @@ class AppkbTransformer(BaseTransformer):
     def debitCardTransform(self, tx):
         if "Debitkarten-" not in tx['camt']['AdditionalEntryInformation']:
             return tx
-        match = self.DEBIT_REGEX.match(tx['camt']['AdditionalEntryInformation'])
-        if not match:
+        parsed = self._describe('debit', tx['camt']['AdditionalEntryInformation'], self._parseDebitCard)
+        if not parsed:
             return tx
+
+        self._setOtherParty(tx['firefly'], parsed['party'])
+        self._addNotes(tx['firefly'], parsed['notes'])
+
+        return tx
+
+    def _parseDebitCard(self, text):
+        match = self.DEBIT_REGEX.match(text)
+        if not match:
+            return None
         g = match.groups()
 
         datetime = g[0]
         recipient = g[1]
         card = g[2]
 
-        self._setOtherParty(tx['firefly'], recipient)
-        self._addNotes(tx['firefly'], "Purchase Date: {}\nCard No.: {}".format(datetime, card))
-
-        return tx
+        return {
+            'party': recipient,
+            'notes': "Purchase Date: {}\nCard No.: {}".format(datetime, card),
+        }
     
     def twintTransform(self, tx):
         if "TWINT" not in tx['camt']['AdditionalEntryInformation']:
             return tx
 
-        match = self.TWINT_REGEX.match(tx['camt']['AdditionalEntryInformation'])
-        if not match:
+        parsed = self._describe('twint', tx['camt']['AdditionalEntryInformation'], self._parseTwint)
+        if not parsed:
             return tx
+
+        self._setOtherParty(tx['firefly'], parsed['party'])
+        self._addNotes(tx['firefly'], parsed['notes'])
+
+        return tx
+
+    def _parseTwint(self, text):
+        match = self.TWINT_REGEX.match(text)
+        if not match:
+            return None
         g = match.groups()
 
         recipient = g[0]
         number = g[1]
 
-        self._setOtherParty(tx['firefly'], recipient)
-        self._addNotes(tx['firefly'], "Twint Account ID: {}".format(number))
-
-        return tx
+        return {
+            'party': recipient,
+            'notes': "Twint Account ID: {}".format(number),
+        }
 
     def ebillTransform(self, tx):
         if "eBill" not in tx['camt']['AdditionalEntryInformation']:
@@ -237,6 +334,7 @@ class ZkbTransformer(BaseTransformer):
             self.twintTransform,
             self.lsvTransform,
             self.unpackTransform,
+            self.nameMatchTransform,
             self.tagTransform,
         ]
     
@@ -293,55 +391,79 @@ class ZkbTransformer(BaseTransformer):
         if "Visa Debit" not in tx['csv']['Buchungstext']:
             return tx
 
-        if "Card Nr." in tx['csv']['Buchungstext']:
-            match = self.DEBIT_REGEX_DE.match(tx['csv']['Buchungstext'])
+        parsed = self._describe('card', tx['csv']['Buchungstext'], self._parseCard)
+        if not parsed:
+            return tx
+
+        self._setOtherParty(tx['firefly'], parsed['party'])
+        self._addNotes(tx['firefly'], parsed['notes'])
+
+        return tx
+
+    def _parseCard(self, text):
+        if "Card Nr." in text:
+            match = self.DEBIT_REGEX_DE.match(text)
         else:
-            match = self.DEBIT_REGEX_EN.match(tx['csv']['Buchungstext'])
+            match = self.DEBIT_REGEX_EN.match(text)
         if not match:
-            return tx
+            return None
         g = match.groups()
 
         card = g[0]
         recipient = g[1]
 
-        self._setOtherParty(tx['firefly'], recipient)
-        self._addNotes(tx['firefly'], "Card No.: {}".format(card))
-
-        return tx
+        return {
+            'party': recipient,
+            'notes': "Card No.: {}".format(card),
+        }
     
     def twintTransform(self, tx):
         if "TWINT" not in tx['csv']['Buchungstext']:
             return tx
 
-        match = self.TWINT_REGEX.match(tx['csv']['Buchungstext'])
-        if not match:
+        parsed = self._describe('twint', tx['csv']['Buchungstext'], self._parseTwint)
+        if not parsed:
             return tx
-        g = match.groups()
 
-        recipient = g[0]
-
-        self._setOtherParty(tx['firefly'], recipient)
+        self._setOtherParty(tx['firefly'], parsed['party'])
 
         return tx
 
+    def _parseTwint(self, text):
+        match = self.TWINT_REGEX.match(text)
+        if not match:
+            return None
+        g = match.groups()
+
+        return {
+            'party': g[0],
+        }
+
     def lsvTransform(self, tx):
         if not ("Lastschrift" in tx['csv']['Buchungstext'] or "LSV" in tx['csv']['Buchungstext']):
             return tx
 
-        if "Lastschrift" in tx['csv']['Buchungstext']:
-            match = self.LSV_REGEX_DE.match(tx['csv']['Buchungstext'])
-        else:
-            match = self.LSV_REGEX_EN.match(tx['csv']['Buchungstext'])
-        if not match:
+        parsed = self._describe('lsv', tx['csv']['Buchungstext'], self._parseLsv)
+        if not parsed:
             return tx
-        g = match.groups()
-
-        recipient = g[0]
 
-        self._setOtherParty(tx['firefly'], recipient)
+        self._setOtherParty(tx['firefly'], parsed['party'])
 
         return tx
 
+    def _parseLsv(self, text):
+        if "Lastschrift" in text:
+            match = self.LSV_REGEX_DE.match(text)
+        else:
+            match = self.LSV_REGEX_EN.match(text)
+        if not match:
+            return None
+        g = match.groups()
+
+        return {
+            'party': g[0],
+        }
+
 class VisecaTransformer(BaseTransformer):
     TAG_SUFFIX = "viseca"
 
@@ -353,6 +475,7 @@ class VisecaTransformer(BaseTransformer):
             self.depositTransform,
             self.categoryTransform,
             self.unpackTransform,
+            self.nameMatchTransform,
             self.tagTransform,
         ]
     
@@ -412,6 +535,7 @@ class UbsTransformer(BaseTransformer):
     ACCOUNT_REGEX = re.compile(r"Konto-Nr\. IBAN: ([^;]+)")
 
     _prevDate = None
+    _batch = None
 
     def __init__(self, firefly, debug=False):
         super().__init__(firefly, debug)
@@ -420,9 +544,14 @@ class UbsTransformer(BaseTransformer):
             self.twintTransform,
             self.ibanTransform,
             self.unpackTransform,
+            self.nameMatchTransform,
             self.tagTransform,
         ]
 
+    def reset(self):
+        self._prevDate = None
+        self._batch = None
+
     def baseTransform(self, csv):
         if self.debug:
             import pprint
@@ -430,15 +559,22 @@ class UbsTransformer(BaseTransformer):
 
         if csv['Beschreibung1'] == 'Diverse Daueraufträge':
             self._prevDate = csv['Abschlussdatum']
+            self._batch = (csv['Transaktions-Nr.'] or self._prevDate, "{} {}".format(csv['Beschreibung1'], self._prevDate))
             return None
+        batch = None
         if not csv['Abschlussdatum']:
+            # sub-entry of the last batch booking
             csv['Abschlussdatum'] = self._prevDate
+            batch = self._batch
+        else:
+            self._batch = None
 
         amount = csv['Belastung'] or csv['Gutschrift'] or csv['Einzelbetrag']
 
         newData = {
             'csv': csv,
             'dir': 'debit' if amount.startswith('-') else 'credit',
+            'batch': batch,
         }
 
         fireflyTx = ff.TransactionSplitStore(
@@ -460,24 +596,42 @@ class UbsTransformer(BaseTransformer):
         return newData
 
     def twintTransform(self, tx):
-        match = self.TWINT_REGEX.match(tx['csv']['Beschreibung3'])
-        if not match:
+        if not tx['csv']['Beschreibung3'].startswith("Zahlungsgrund: "):
             return tx
+        # the recipient depends on all three description columns
+        text = "\x1f".join([tx['csv']['Beschreibung1'], tx['csv']['Beschreibung2'], tx['csv']['Beschreibung3']])
+        parsed = self._describe('twint', text, self._parseTwint)
+        if not parsed:
+            return tx
+
+        if parsed['notes']:
+            self._addNotes(tx['firefly'], parsed['notes'])
+        tx['firefly'].description = f"TWINT: {parsed['party']}"
+        self._setOtherParty(tx['firefly'], parsed['party'])
+        return tx
+
+    def _parseTwint(self, text):
+        description1, description2, description3 = text.split("\x1f")
+        match = self.TWINT_REGEX.match(description3)
+        if not match:
+            return None
         g = match.groups()
 
+        notes = None
         recipient = g[0]
         if recipient.startswith("+"):
-            self._addNotes(tx['firefly'], "TWINT Phone Number: {}".format(recipient))
-            if tx['csv']['Beschreibung2'] == 'Gutschrift UBS TWINT':
-                recipient = tx['csv']['Beschreibung1'].upper()
+            notes = "TWINT Phone Number: {}".format(recipient)
+            if description2 == 'Gutschrift UBS TWINT':
+                recipient = description1.upper()
             else:
-                recipient = tx['csv']['Beschreibung1'].replace('; Belastung UBS TWINT', '')
+                recipient = description1.replace('; Belastung UBS TWINT', '')
         else:
-            recipient = tx['csv']['Beschreibung1'].replace('; Zahlung UBS TWINT', '').upper()
+            recipient = description1.replace('; Zahlung UBS TWINT', '').upper()
 
-        tx['firefly'].description = f"TWINT: {recipient}"
-        self._setOtherParty(tx['firefly'], recipient)
-        return tx
+        return {
+            'party': recipient,
+            'notes': notes,
+        }
 
     def ibanTransform(self, tx):
         match = self.ACCOUNT_REGEX.match(tx['csv']['Beschreibung3'])
@@ -535,9 +689,14 @@ class UbsCardTransformer(BaseTransformer):
             self.baseTransform,
             self.industryTransform,
             self.unpackTransform,
+            self.nameMatchTransform,
             self.tagTransform,
         ]
 
+    def reset(self):
+        self.date_index = 0
+        self.prev_date = None
+
     def baseTransform(self, csv):
         if self.debug:
             import pprint
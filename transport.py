@@ -0,0 +1,57 @@
+from types import SimpleNamespace
+
+import firefly_iii_client as ff
+import requests
+
+
+class LeanTransport:
+    """
+    Minimal JSON transport for the endpoints the importer hits once per row.
+
+    Requests are sent as pre-serialized JSON and only the fields the importer reads
+    are picked out of the response, skipping the generated client's model construction
+    and validation. Errors are raised as ApiException so callers can't tell the difference.
+    """
+
+    def __init__(self, conf, poolSize=1):
+        self.host = conf.host.rstrip('/')
+        self.verify = conf.verify_ssl
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Authorization': 'Bearer {}'.format(conf.access_token),
+            'Accept': 'application/json',
+            'Content-Type': 'application/json',
+        })
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(poolSize, 1))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _request(self, method, path, params=None, data=None):
+        resp = self.session.request(method, self.host + path, params=params, data=data, verify=self.verify)
+        if resp.status_code >= 400:
+            e = ff.exceptions.ApiException(status=resp.status_code, reason=resp.reason, body=resp.text)
+            e.headers = resp.headers
+            raise e
+        return resp.json()
+
+    @staticmethod
+    def _first(resp):
+        if resp['data']:
+            return SimpleNamespace(id=resp['data'][0]['id'])
+        return None
+
+    def search_accounts(self, query, field, type):
+        return self._first(self._request('GET', '/v1/search/accounts', params={
+            'query': query,
+            'field': field.value,
+            'type': type.value,
+        }))
+
+    def search_transactions(self, query):
+        return self._first(self._request('GET', '/v1/search/transactions', params={
+            'query': query,
+        }))
+
+    def store_transaction(self, transactionStore):
+        body = transactionStore.model_dump_json(by_alias=True, exclude_none=True)
+        return SimpleNamespace(id=self._request('POST', '/v1/transactions', data=body)['data']['id'])